@@ -1,86 +1,199 @@
 import os
-import json
-import re
+import orjson
 import asyncio
+import signal
 import discord
 from discord.ext import commands
 from discord import app_commands
 from myserver import server_on
+from utils import ROLE_MENTION_RE, normalize_emoji_key, emoji_key_from_payload, ensure_react_permissions, role_name_index
 
 # ---------------------- CONFIG & INTENTS ----------------------
 intents = discord.Intents.default()
 intents.guilds = True
-intents.members = True
+intents.members = False
 intents.messages = True
 intents.message_content = False
 intents.reactions = True
 
-bot = commands.Bot(command_prefix="/", intents=intents)
+class YukaBot(commands.Bot):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.reaction_roles = {}
+        self.verify_config = {}
+
+    async def setup_hook(self):
+        global _reaction_log_lines, _flush_task, BOT_USER_ID
+        # login() เสร็จก่อน setup_hook เสมอ จึงมี self.user แล้ว
+        BOT_USER_ID = self.user.id
+        # โหลดไฟล์ใน thread เพื่อไม่ให้ block event loop
+        base = None
+        if os.path.exists(LEGACY_REACTION_FILE):
+            # ย้ายข้อมูลจากไฟล์ .json เดิม: เริ่มจากข้อมูลเดิมแล้ว replay log ทับ
+            # ไฟล์เดิมจะถูกเปลี่ยนชื่อหลังเขียน .jsonl แบบ compact สำเร็จ
+            legacy = await asyncio.to_thread(load_json, LEGACY_REACTION_FILE)
+            base = {int(k): v for k, v in legacy.items()}
+            mark_dirty(REACTION_FILE)
+        self.reaction_roles, _reaction_log_lines = await asyncio.to_thread(load_jsonl, REACTION_FILE, base)
+        self.verify_config = await asyncio.to_thread(load_json, VERIFY_FILE)
+        # ผูกปุ่ม verify เดิมกลับเข้าข้อความหลังรีสตาร์ท
+        for cfg in self.verify_config.values():
+            self.add_view(VerifyView(cfg["role_id"]), message_id=cfg["message_id"])
+        _flush_task = asyncio.create_task(_flush_loop())
+        # Render ส่ง SIGTERM ตอน redeploy: ปิดบอทผ่าน close() เพื่อ flush ข้อมูลก่อน
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except NotImplementedError:
+            pass
+
+    async def close(self):
+        # เขียนข้อมูลที่ยังค้างใน debounce ก่อนปิด connection
+        try:
+            await flush_dirty()
+        except Exception as e:
+            print("Failed to save data:", e)
+        await super().close()
+
+bot = YukaBot(command_prefix="/", intents=intents)
 TREE_SYNCED = False
+BOT_USER_ID = 0
 
 # ---------------------- DATA FILES ----------------------
-REACTION_FILE = "reaction_roles.json"
+REACTION_FILE = "reaction_roles.jsonl"
+LEGACY_REACTION_FILE = "reaction_roles.json"
 VERIFY_FILE = "verify_config.json"
+COMPACT_MIN_LINES = 100
 
 def load_json(path):
     if not os.path.exists(path):
         return {}
-    with open(path, "r", encoding="utf-8") as f:
+    with open(path, "rb") as f:
         try:
-            return json.load(f)
+            return orjson.loads(f.read())
         except Exception:
             return {}
 
-def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-reaction_roles = load_json(REACTION_FILE)
-verify_config = load_json(VERIFY_FILE)
+def load_jsonl(path, data=None):
+    # อ่าน log แบบ append-only (replay ทับ data ถ้ามี) -> (ข้อมูลล่าสุด, จำนวนบรรทัดในไฟล์)
+    if data is None:
+        data = {}
+    lines = 0
+    if not os.path.exists(path):
+        return data, lines
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            lines += 1
+            try:
+                record = orjson.loads(line)
+                key = int(record.pop("id"))
+            except Exception:
+                # บรรทัดสุดท้ายอาจขาดถ้าบอทดับระหว่างเขียน
+                continue
+            if record.get("deleted"):
+                data.pop(key, None)
+            else:
+                data[key] = record
+    return data, lines
+
+def dumps_json(data):
+    return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
+def dumps_jsonl(data):
+    return b"".join(orjson.dumps({"id": k, **v}) + b"\n" for k, v in data.items())
+
+def _write_atomic(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _write_file(path, data):
+    _write_atomic(path, data)
+    if path == REACTION_FILE and os.path.exists(LEGACY_REACTION_FILE):
+        # .jsonl มีข้อมูลครบแล้ว ไม่ต้องย้ายซ้ำตอนเริ่มครั้งหน้า
+        os.replace(LEGACY_REACTION_FILE, LEGACY_REACTION_FILE + ".migrated")
+
+def _append_line(path, line):
+    with open(path, "ab+") as f:
+        # ถ้าบรรทัดท้ายขาด (บอทดับระหว่างเขียน) ขึ้นบรรทัดใหม่ก่อน ไม่ให้ record ใหม่ไปต่อท้ายเศษนั้น
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                line = b"\n" + line
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+# ---------------------- DEBOUNCED SAVE ----------------------
+FLUSH_INTERVAL = 2.0
+_dirty: set[str] = set()
+_flush_task: asyncio.Task | None = None
+_write_lock = asyncio.Lock()
+_reaction_log_lines = 0
+
+def _serialize(path):
+    if path == REACTION_FILE:
+        return dumps_jsonl(bot.reaction_roles)
+    return dumps_json(bot.verify_config)
+
+def mark_dirty(path):
+    _dirty.add(path)
+
+async def flush_dirty():
+    global _reaction_log_lines
+    while _dirty:
+        path = _dirty.pop()
+        try:
+            async with _write_lock:
+                # serialize ใน lock บน event loop แล้วค่อยเขียนไฟล์ใน thread
+                data = _serialize(path)
+                await asyncio.to_thread(_write_file, path, data)
+        except Exception:
+            _dirty.add(path)
+            raise
+        if path == REACTION_FILE:
+            _reaction_log_lines = data.count(b"\n")
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await flush_dirty()
+        except Exception as e:
+            print("Failed to save data:", e)
+
+async def append_reaction_record(message_id, record):
+    # เพิ่ม/ลบ reaction role = เขียนต่อท้ายไฟล์ 1 บรรทัด ไม่ต้องเขียนทั้งไฟล์ใหม่
+    global _reaction_log_lines
+    line = orjson.dumps({"id": int(message_id), **record}) + b"\n"
+    async with _write_lock:
+        await asyncio.to_thread(_append_line, REACTION_FILE, line)
+    _reaction_log_lines += 1
+    if _reaction_log_lines > max(COMPACT_MIN_LINES, 2 * len(bot.reaction_roles)):
+        mark_dirty(REACTION_FILE)
 
 # ---------------------- HELPERS ----------------------
-EMOJI_RE = re.compile(r"^<a?:[A-Za-z0-9_~]+:(\d+)>$")
-
-def normalize_emoji_key(s: str) -> str:
-    s = s.strip()
-    m = EMOJI_RE.match(s)
-    if m:
-        return f"e:{m.group(1)}"
-    return s
-
-def emoji_key_from_payload(payload_emoji) -> str:
-    if payload_emoji.id:
-        return f"e:{payload_emoji.id}"
-    return str(payload_emoji)
-
-async def ensure_react_permissions(channel: discord.TextChannel):
-    perms = channel.permissions_for(channel.guild.me)
-    needed = [
-        (perms.manage_roles, "Manage Roles"),
-        (perms.add_reactions, "Add Reactions"),
-        (perms.read_message_history, "Read Message History"),
-        (perms.send_messages, "Send Messages"),
-        (perms.embed_links, "Embed Links"),
-        (perms.read_messages, "View Channel"),
-    ]
-    missing = [name for ok, name in needed if not ok]
-    if missing:
-        raise PermissionError("บอทขาดสิทธิ์: " + ", ".join(missing))
-
 async def add_reactions_safely(message: discord.Message, emoji_keys):
-    for key in emoji_keys:
+    async def _one(key):
+        if key.startswith("e:"):
+            # cache อิโมจิของ discord.py เอง (dict ตาม id) อัปเดตให้ตลอด
+            emoji = bot.get_emoji(int(key.split(":", 1)[1]))
+            if emoji is None:
+                return
+        else:
+            emoji = key
         try:
-            if key.startswith("e:"):
-                emoji_id = int(key.split(":", 1)[1])
-                emoji = discord.utils.get(message.guild.emojis, id=emoji_id)
-                if emoji is None:
-                    continue
-                await message.add_reaction(emoji)
-            else:
-                await message.add_reaction(key)
-            await asyncio.sleep(0.3)
+            await message.add_reaction(emoji)
         except Exception:
-            continue
+            return
+
+    # discord.py จัดการ rate-limit bucket ให้เอง จึงยิงพร้อมกันได้
+    await asyncio.gather(*(_one(k) for k in emoji_keys), return_exceptions=True)
 
 # ---------------------- EVENTS ----------------------
 @bot.event
@@ -97,9 +210,9 @@ async def on_ready():
 
 @bot.event
 async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
-    if payload.user_id == bot.user.id:
+    if payload.user_id == BOT_USER_ID:
         return
-    data = reaction_roles.get(str(payload.message_id))
+    data = bot.reaction_roles.get(payload.message_id)
     if not data:
         return
     key = emoji_key_from_payload(payload.emoji)
@@ -109,9 +222,13 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
     guild = bot.get_guild(payload.guild_id)
     if guild is None:
         return
-    member = guild.get_member(payload.user_id)
+    # role ที่สูงกว่า role ของบอท ให้ไม่ได้อยู่แล้ว ตัดทิ้งก่อนหา member
     role = guild.get_role(role_id)
-    if member and role:
+    if role is None or not role.is_assignable():
+        return
+    # payload.member มีมาให้แล้วใน guild ไม่ต้องพึ่ง member cache
+    member = payload.member or guild.get_member(payload.user_id)
+    if member:
         try:
             await member.add_roles(role, reason=f"Reaction role via {key}")
             await send_log(guild, f"✅ {member.mention} ได้รับ role {role.mention} ผ่าน reaction")
@@ -120,7 +237,9 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
 
 @bot.event
 async def on_raw_reaction_remove(payload: discord.RawReactionActionEvent):
-    data = reaction_roles.get(str(payload.message_id))
+    if payload.user_id == BOT_USER_ID:
+        return
+    data = bot.reaction_roles.get(payload.message_id)
     if not data:
         return
     key = emoji_key_from_payload(payload.emoji)
@@ -130,14 +249,21 @@ async def on_raw_reaction_remove(payload: discord.RawReactionActionEvent):
     guild = bot.get_guild(payload.guild_id)
     if guild is None:
         return
-    member = guild.get_member(payload.user_id)
     role = guild.get_role(role_id)
-    if member and role:
+    if role is None or not role.is_assignable():
+        return
+    # event ลบ reaction ไม่มี payload.member และ cache อาจไม่มีสมาชิกคนนี้
+    member = guild.get_member(payload.user_id)
+    if member is None:
         try:
-            await member.remove_roles(role, reason=f"Reaction role removed via {key}")
-            await send_log(guild, f"❌ {member.mention} ถูกลบ role {role.mention} ผ่าน reaction")
-        except discord.Forbidden:
-            pass
+            member = await guild.fetch_member(payload.user_id)
+        except discord.HTTPException:
+            return
+    try:
+        await member.remove_roles(role, reason=f"Reaction role removed via {key}")
+        await send_log(guild, f"❌ {member.mention} ถูกลบ role {role.mention} ผ่าน reaction")
+    except discord.Forbidden:
+        pass
 
 # ---------------------- VERIFY SYSTEM ----------------------
 class VerifyView(discord.ui.View):
@@ -165,17 +291,19 @@ async def verifysetup(interaction: discord.Interaction, channel: discord.TextCha
     embed = discord.Embed(title="บอทยืนยันตัวตน", description="กดปุ่มด้านล่างเพื่อยืนยันตัวตนและรับยศ")
     view = VerifyView(role.id)
     msg = await channel.send(embed=embed, view=view)
-    verify_config[str(interaction.guild.id)] = {"role_id": role.id, "log_channel": log_channel.id, "message_id": msg.id, "channel_id": channel.id}
-    save_json(VERIFY_FILE, verify_config)
+    bot.verify_config[str(interaction.guild.id)] = {"role_id": role.id, "log_channel": log_channel.id, "message_id": msg.id, "channel_id": channel.id}
+    mark_dirty(VERIFY_FILE)
     await interaction.response.send_message(f"✅ สร้างระบบ Verify ใน {channel.mention} แล้ว", ephemeral=True)
 
 
 @bot.tree.command(name="delreactionrole", description="ลบ reaction role ที่สร้างไว้")
 @app_commands.checks.has_permissions(manage_roles=True)
 async def delreactionrole(interaction: discord.Interaction, message_id: str):
-    if message_id in reaction_roles:
-        del reaction_roles[message_id]
-        save_json(REACTION_FILE, reaction_roles)
+    message_id = message_id.strip()
+    msg_id = int(message_id) if message_id.isdecimal() else None
+    if msg_id in bot.reaction_roles:
+        del bot.reaction_roles[msg_id]
+        await append_reaction_record(msg_id, {"deleted": True})
         await interaction.response.send_message(f"✅ ลบ reaction role ของ message {message_id} แล้ว", ephemeral=True)
     else:
         await interaction.response.send_message("❌ ไม่พบ reaction role สำหรับ message นี้", ephemeral=True)
@@ -184,7 +312,7 @@ async def delreactionrole(interaction: discord.Interaction, message_id: str):
 
 # ---------------------- LOG FUNCTION ----------------------
 async def send_log(guild: discord.Guild, text: str):
-    config = verify_config.get(str(guild.id), {})
+    config = bot.verify_config.get(str(guild.id), {})
     log_channel_id = config.get("log_channel")
     if log_channel_id:
         ch = guild.get_channel(log_channel_id)
@@ -207,8 +335,9 @@ async def createrole(interaction: discord.Interaction, channel: discord.TextChan
         await ensure_react_permissions(channel)
 
         # parse input pairs
+        name_index = None
         items = []
-        for raw in re.split(r",|\n", pairs):
+        for raw in pairs.replace("\n", ",").split(","):
             item = raw.strip()
             if not item:
                 continue
@@ -216,30 +345,35 @@ async def createrole(interaction: discord.Interaction, channel: discord.TextChan
                 raise ValueError(f"รูปแบบไม่ถูกต้อง: '{item}' (ควรเป็น EMOJI=ROLE)")
             emoji_part, role_part = [p.strip() for p in item.split("=", 1)]
             role = None
-            m = re.search(r"<@&(?P<id>\d+)>", role_part)
+            m = ROLE_MENTION_RE.search(role_part)
             if m:
-                role = interaction.guild.get_role(int(m.group("id")))
+                role = interaction.guild.get_role(int(m.group(1)))
             elif role_part.isdigit():
                 role = interaction.guild.get_role(int(role_part))
             else:
-                role = discord.utils.get(interaction.guild.roles, name=role_part)
+                # สร้าง index ชื่อ role ครั้งเดียว เฉพาะเมื่อมีการอ้างด้วยชื่อ
+                if name_index is None:
+                    name_index = role_name_index(interaction.guild)
+                roles_by_name, roles_by_lower = name_index
+                role = roles_by_name.get(role_part) or roles_by_lower.get(role_part.lower())
             if not role:
                 raise ValueError(f"ไม่พบ role: {role_part}")
             emoji_key = normalize_emoji_key(emoji_part)
-            items.append((emoji_key, role.id, emoji_part))
+            items.append((emoji_key, role, emoji_part))
 
         # embed
         embed = discord.Embed(title=title, description=description)
-        lines = [f"{emoji} → {interaction.guild.get_role(role_id).mention}" for _, role_id, emoji in items]
+        lines = [f"{emoji} → {role.mention}" for _, role, emoji in items]
         embed.add_field(name="กดอิโมจิเพื่อรับยศ", value="\n".join(lines), inline=False)
         embed.set_footer(text="เอาอิโมจิออก = ถอนยศ")
         if image_url:
             embed.set_image(url=image_url)
 
         msg = await channel.send(embed=embed)
-        emoji_map = {ek: rid for ek, rid, _ in items}
-        reaction_roles[str(msg.id)] = {"emoji_map": emoji_map, "guild_id": interaction.guild.id, "channel_id": channel.id}
-        save_json(REACTION_FILE, reaction_roles)
+        emoji_map = {ek: role.id for ek, role, _ in items}
+        record = {"emoji_map": emoji_map, "guild_id": interaction.guild.id, "channel_id": channel.id}
+        bot.reaction_roles[msg.id] = record
+        await append_reaction_record(msg.id, record)
         await add_reactions_safely(msg, emoji_map.keys())
 
         await interaction.followup.send(f"✅ สร้างข้อความรับยศแล้วใน {channel.mention} (message id: {msg.id})", ephemeral=True)
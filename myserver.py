@@ -11,5 +11,5 @@ def run():
     app.run(host='0.0.0.0', port=8080)
 
 def server_on():
-    t = Thread(target=run)
+    t = Thread(target=run, daemon=True)
     t.start()
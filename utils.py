@@ -0,0 +1,47 @@
+import re
+import discord
+
+EMOJI_RE = re.compile(r"^<a?:[A-Za-z0-9_~]+:(\d+)>$")
+ROLE_MENTION_RE = re.compile(r"<@&(\d+)>")
+
+def normalize_emoji_key(s: str) -> str:
+    s = s.strip()
+    # อิโมจิ unicode ไม่มีทางขึ้นต้นด้วย '<' ข้าม regex ไปเลย
+    if s[:1] != "<":
+        return s
+    m = EMOJI_RE.match(s)
+    if m:
+        return f"e:{m.group(1)}"
+    return s
+
+def role_name_index(guild: discord.Guild):
+    # ชื่อตรงตัว และชื่อตัวพิมพ์เล็ก -> role (ชื่อซ้ำ: เอา role ที่ต่ำสุดเหมือน discord.utils.get)
+    by_name = {}
+    by_lower = {}
+    for r in guild.roles:
+        by_name.setdefault(r.name, r)
+        by_lower.setdefault(r.name.lower(), r)
+    return by_name, by_lower
+
+def emoji_key_from_payload(payload_emoji) -> str:
+    if payload_emoji.id:
+        return f"e:{payload_emoji.id}"
+    return str(payload_emoji)
+
+# สิทธิ์ที่บอทต้องมีในห้อง reaction role: (bit, ชื่อที่แสดง)
+REQUIRED_PERM_BITS = [
+    (discord.Permissions(manage_roles=True).value, "Manage Roles"),
+    (discord.Permissions(add_reactions=True).value, "Add Reactions"),
+    (discord.Permissions(read_message_history=True).value, "Read Message History"),
+    (discord.Permissions(send_messages=True).value, "Send Messages"),
+    (discord.Permissions(embed_links=True).value, "Embed Links"),
+    (discord.Permissions(read_messages=True).value, "View Channel"),
+]
+REQUIRED_PERMS = discord.Permissions(sum(bit for bit, _ in REQUIRED_PERM_BITS))
+
+async def ensure_react_permissions(channel: discord.TextChannel):
+    perms = channel.permissions_for(channel.guild.me)
+    missing_mask = REQUIRED_PERMS.value & ~perms.value
+    if missing_mask:
+        missing = [name for bit, name in REQUIRED_PERM_BITS if missing_mask & bit]
+        raise PermissionError("บอทขาดสิทธิ์: " + ", ".join(missing))